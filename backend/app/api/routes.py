@@ -1,8 +1,11 @@
 """
 API 路由定义
 """
+import asyncio
+import logging
+from itertools import islice
 from typing import Optional
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Query, Request, Response
 
 from app.models.schemas import (
     ImageSyncRequest,
@@ -15,10 +18,20 @@ from app.models.schemas import (
 from app.services.image_sync import image_sync_service
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
-# 存储 Harbor 配置（运行时）
-_harbor_config: Optional[HarborConfig] = None
+
+async def _get_harbor_config(http_request: Request) -> Optional[HarborConfig]:
+    """
+    读取运行时保存的 Harbor 配置（存放在 app.state 中）
+    :param http_request:
+    :return:
+    """
+    state = http_request.app.state
+    async with state.harbor_lock:
+        return state.harbor_config
 
 
 @router.get("/health")
@@ -31,65 +44,77 @@ async def health_check():
 
 
 @router.get("/config", response_model=ConfigResponse)
-async def get_config():
+async def get_config(http_request: Request):
     """
     获取系统配置状态
+    :param http_request:
     :return:
     """
-    global _harbor_config
+    harbor_config = await _get_harbor_config(http_request)
+    
+    docker_available, skopeo_available, buildx_available = await asyncio.gather(
+        image_sync_service.check_docker_available(),
+        image_sync_service.check_skopeo_available(),
+        image_sync_service.check_buildx_available()
+    )
     
     harbor_configured = bool(
-        _harbor_config is not None
+        harbor_config is not None
         or (settings.harbor_registry and settings.harbor_username)
     )
     
     return ConfigResponse(
         harbor_configured=harbor_configured,
-        docker_available=image_sync_service.check_docker_available(),
-        skopeo_available=image_sync_service.check_skopeo_available(),
-        buildx_available=image_sync_service.check_buildx_available(),
+        docker_available=docker_available,
+        skopeo_available=skopeo_available,
+        buildx_available=buildx_available,
         default_registry=settings.harbor_registry,
         default_username=settings.harbor_username
     )
 
 
 @router.post("/config/harbor")
-async def set_harbor_config(config: HarborConfig):
+async def set_harbor_config(config: HarborConfig, http_request: Request):
     """
     设置 Harbor 配置
     :param config:
+    :param http_request:
     :return:
     """
-    global _harbor_config
-    _harbor_config = config
-    print(f"[DEBUG] Harbor 配置已保存: registry={config.registry}, username={config.username}")
+    state = http_request.app.state
+    async with state.harbor_lock:
+        state.harbor_config = config
+    logger.debug("Harbor 配置已保存: registry=%s, username=%s", config.registry, config.username)
     return {"status": "ok", "message": f"Harbor 配置已保存，用户: {config.username}"}
 
 
 @router.post("/sync", response_model=ImageSyncResponse)
 async def sync_image(
         request: ImageSyncRequest,
-        background_tasks: BackgroundTasks
+        http_request: Request
 ):
     """
     创建镜像同步任务
     :param request:
-    :param background_tasks:
+    :param http_request:
     :return:
     """
-    global _harbor_config
+    harbor_config = await _get_harbor_config(http_request)
     
     # 检查 Docker 是否可用
-    if not image_sync_service.check_docker_available():
+    if not await image_sync_service.check_docker_available():
         raise HTTPException(
             status_code=500,
             detail="Docker 未安装或未运行"
         )
     
     # 解析源镜像
-    source_registry, source_name, source_tag = image_sync_service.parse_image_reference(
-        request.source_image
-    )
+    try:
+        source_registry, source_name, source_tag, _ = image_sync_service.parse_image_reference(
+            request.source_image
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     # 确定目标镜像名
     if request.target_image_name:
@@ -100,8 +125,13 @@ async def sync_image(
         if target_name.startswith("library/"):
             target_name = target_name[8:]
     
-    # 确定目标 tag
+    # 确定目标 tag（源镜像只指定 digest 时没有可沿用的 tag）
     target_tag = request.target_tag if request.target_tag else source_tag
+    if not target_tag:
+        raise HTTPException(
+            status_code=400,
+            detail="源镜像只指定了 digest，请填写目标 tag"
+        )
     
     # 构建完整的目标镜像地址
     target_image = f"{request.target_registry}/{request.target_project}/{target_name}:{target_tag}"
@@ -110,126 +140,95 @@ async def sync_image(
     harbor_username = None
     harbor_password = None
     
-    print(f"[DEBUG] 检查 Harbor 配置: _harbor_config={_harbor_config is not None}")
-    if _harbor_config:
-        harbor_username = _harbor_config.username
-        harbor_password = _harbor_config.password
-        print(f"[DEBUG] 使用前端配置: username={harbor_username}")
+    logger.debug("检查 Harbor 配置: harbor_config=%s", harbor_config is not None)
+    if harbor_config:
+        harbor_username = harbor_config.username
+        harbor_password = harbor_config.password
+        logger.debug("使用前端配置: username=%s", harbor_username)
     elif settings.harbor_username and settings.harbor_password:
         harbor_username = settings.harbor_username
         harbor_password = settings.harbor_password
-        print(f"[DEBUG] 使用 .env 配置: username={harbor_username}")
-    
-    # 检查是否使用 skopeo
-    use_skopeo = image_sync_service.check_skopeo_available()
-    
-    # 在后台执行同步任务
-    async def run_sync():
-        await image_sync_service.sync_image(
-            source_image=request.source_image,
-            target_image=target_image,
-            platforms=request.platforms,
-            harbor_username=harbor_username,
-            harbor_password=harbor_password,
-            use_skopeo=use_skopeo
+        logger.debug("使用 .env 配置: username=%s", harbor_username)
+    
+    # Skopeo 可用时优先使用（直接在仓库间流式复制，无需本地存储）
+    use_skopeo = await image_sync_service.check_skopeo_available()
+    sync_mode = "skopeo" if use_skopeo else "docker"
+    
+    # 创建任务并在后台执行实际同步
+    try:
+        task = image_sync_service.create_task(
+            request.source_image,
+            target_image,
+            request.platforms
         )
-    
-    # 创建任务并立即返回
-    import uuid
-    task_id = str(uuid.uuid4())[:8]
-    
-    # 先创建任务记录
-    from app.services.image_sync import SyncTask
-    task = SyncTask(
-        task_id=task_id,
-        source_image=request.source_image,
-        target_image=target_image,
-        platforms=request.platforms,
-        status=SyncStatus.PENDING
+    except RuntimeError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    image_sync_service.run_in_background(
+        task,
+        harbor_username,
+        harbor_password,
+        use_skopeo=use_skopeo
     )
-    image_sync_service.tasks[task_id] = task
-    
-    # 在后台执行实际同步
-    async def execute_sync():
-        task.status = SyncStatus.PULLING
-        task.logs.append(f"开始同步任务: {task_id}")
-        task.logs.append(f"源镜像: {request.source_image}")
-        task.logs.append(f"目标镜像: {target_image}")
-        task.logs.append(f"平台: {[p.value for p in request.platforms]}")
-        
-        try:
-            if use_skopeo:
-                success = await image_sync_service.sync_image_with_skopeo(
-                    task,
-                    harbor_username,
-                    harbor_password
-                )
-            else:
-                success = await image_sync_service.sync_image_with_docker(
-                    task,
-                    harbor_username,
-                    harbor_password
-                )
-            
-            if success:
-                task.status = SyncStatus.SUCCESS
-                task.current_step = "同步完成"
-                task.logs.append("✅ 镜像同步成功!")
-            else:
-                task.status = SyncStatus.FAILED
-                task.current_step = "同步失败"
-                if not task.error:
-                    task.error = "同步过程中发生错误"
-                task.logs.append(f"❌ 同步失败: {task.error}")
-                
-        except Exception as e:
-            task.status = SyncStatus.FAILED
-            task.error = str(e)
-            task.current_step = "发生异常"
-            task.logs.append(f"❌ 发生异常: {str(e)}")
-    
-    background_tasks.add_task(execute_sync)
     
     return ImageSyncResponse(
-        task_id=task_id,
+        task_id=task.task_id,
         status=SyncStatus.PENDING,
-        message=f"同步任务已创建，目标: {target_image}"
+        message=f"同步任务已创建（{sync_mode}），目标: {target_image}"
     )
 
 
 @router.get("/sync/{task_id}", response_model=SyncProgress)
-async def get_sync_progress(task_id: str):
+async def get_sync_progress(
+        task_id: str,
+        http_request: Request,
+        response: Response,
+        since: int = Query(default=0, ge=0)
+):
     """
-    获取同步任务进度
+    获取同步任务进度，进度未变化时返回 304
     :param task_id:
+    :param http_request:
+    :param response:
+    :param since: 只返回该行号（从 0 开始累计）之后的日志
     :return:
     """
-    progress = image_sync_service.get_task_progress(task_id)
+    etag = image_sync_service.get_task_etag(task_id, since)
     
-    if not progress:
+    if not etag:
         raise HTTPException(
             status_code=404,
             detail=f"任务 {task_id} 不存在"
         )
     
-    return progress
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if http_request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    return image_sync_service.get_task_progress(task_id, since)
 
 
 @router.get("/tasks")
-async def list_tasks():
+async def list_tasks(
+        limit: int = Query(default=50, ge=1, le=500),
+        offset: int = Query(default=0, ge=0)
+):
     """
-    列出所有任务
+    分页列出任务
+    :param limit:
+    :param offset:
     :return:
     """
+    image_sync_service.prune_tasks()
+    
     tasks = []
-    for task_id, task in image_sync_service.tasks.items():
+    for task in islice(image_sync_service.tasks.values(), offset, offset + limit):
         tasks.append({
-            "task_id": task_id,
+            "task_id": task.task_id,
             "source_image": task.source_image,
             "target_image": task.target_image,
             "status": task.status,
             "progress": task.progress
         })
     
-    return {"tasks": tasks}
-
+    return {"tasks": tasks, "total": len(image_sync_service.tasks)}
@@ -15,9 +15,28 @@ class Settings(BaseSettings):
     harbor_username: Optional[str] = None
     harbor_password: Optional[str] = None
     
+    # Skopeo 配置
+    skopeo_preserve_digests: bool = True
+    skopeo_src_tls_verify: bool = True
+    skopeo_dest_tls_verify: bool = True
+    skopeo_image_parallel_copies: Optional[int] = None
+    
+    # 工具可用性检测结果缓存时间（秒），小于等于 0 表示永不过期
+    tools_availability_ttl: int = 60
+    
+    # 每个任务保留的日志行数上限、内存中保留的任务数上限
+    max_log_lines: int = 2000
+    max_tasks: int = 500
+    # 已结束任务的保留时间（秒）
+    finished_task_ttl: int = 3600
+    
+    # 同时执行的同步任务数上限，小于等于 0 时不限制
+    max_concurrent_syncs: int = 0
+    
     # 应用配置
     app_host: str = "0.0.0.0"
     app_port: int = 8000
+    log_level: str = "INFO"
     
     # 前端 URL（用于 CORS）
     frontend_url: str = "http://localhost:5173"
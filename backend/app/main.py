@@ -1,18 +1,69 @@
 """
 FastAPI 应用主入口
 """
+import asyncio
+import logging
+import queue
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from app.api.routes import router
 from app.config import settings
+from app.services.image_sync import image_sync_service
+
+
+def setup_logging() -> QueueListener:
+    """
+    配置 app.* 日志：记录时只放入队列，由后台线程负责输出
+    :return: 需要启动/停止的 QueueListener
+    """
+    log_queue: queue.Queue = queue.Queue(-1)
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    )
+    
+    logger = logging.getLogger("app")
+    logger.setLevel(settings.log_level.upper())
+    logger.handlers = [QueueHandler(log_queue)]
+    logger.propagate = False
+    
+    return QueueListener(log_queue, stream_handler)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动日志输出线程，退出时取消仍在运行的同步任务
+    :param app:
+    :return:
+    """
+    log_listener = setup_logging()
+    log_listener.start()
+    try:
+        yield
+        await image_sync_service.shutdown()
+    finally:
+        log_listener.stop()
+
 
 app = FastAPI(
     title="Docker Image Sync",
     description="从 DockerHub 同步多平台镜像到内网 Harbor",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+# 运行时状态：前端设置的 Harbor 配置
+app.state.harbor_config = None
+app.state.harbor_lock = asyncio.Lock()
+
 # 配置 CORS
 app.add_middleware(
     CORSMiddleware,
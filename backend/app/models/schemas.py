@@ -58,6 +58,8 @@ class SyncProgress(BaseModel):
     current_step: str
     progress: int = Field(default=0, ge=0, le=100)
     logs: List[str] = Field(default_factory=list)
+    logs_offset: int = Field(default=0, description="logs 中第一行的行号")
+    total_log_lines: int = Field(default=0, description="任务累计产生的日志行数")
     error: Optional[str] = None
 
 
@@ -3,15 +3,70 @@
 支持从 DockerHub 拉取多平台镜像并推送到内网 Harbor
 """
 import asyncio
-import subprocess
+import base64
+import hashlib
+import json
+import os
+import time
 import uuid
 import re
-from typing import Dict, List, Optional, Callable
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Dict, List, Optional, Callable, Awaitable, Deque, Set
 from dataclasses import dataclass, field
 
+import httpx
+
+from app.config import settings
 from app.models.schemas import Platform, SyncStatus, SyncProgress
 
 
+# 子进程输出单行长度上限、run_command 返回的输出行数、待处理输出行的队列长度
+_STREAM_LIMIT = 1024 * 1024
+_OUTPUT_TAIL_LINES = 20
+_LINE_QUEUE_SIZE = 1024
+
+# 镜像引用：[registry/]name[:tag][@sha256:digest]，第一段包含 "." 或 ":" 时才视为 registry
+_IMAGE_REF_RE = re.compile(
+    r"^(?:(?P<registry>[^/]*[.:][^/]*)/)?(?P<name>[^:@]+)(?::(?P<tag>[^:@/]+))?"
+    r"(?:@(?P<digest>sha256:[0-9a-f]{64}))?$"
+)
+
+# skopeo copy --all 逐个复制平台镜像时的进度行
+_SKOPEO_IMAGE_RE = re.compile(r"Copying image \S+ \((\d+)/(\d+)\)")
+
+# 查询 manifest digest 时接受的类型（多平台镜像返回 manifest list / index）
+_MANIFEST_ACCEPT = ", ".join([
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+])
+
+# WWW-Authenticate 头中的 key="value" 参数
+_AUTH_PARAM_RE = re.compile(r'(\w+)="([^"]*)"')
+
+# 需要在日志中隐藏取值的命令行参数
+_SECRET_ARGS = {
+    "--password": "***",
+}
+
+
+def _mask_command(cmd: List[str]) -> str:
+    """
+    拼接命令用于日志输出，并隐藏敏感参数的取值
+    :param cmd:
+    :return:
+    """
+    masked = list(cmd)
+    for i, arg in enumerate(cmd[:-1]):
+        if arg in _SECRET_ARGS:
+            masked[i + 1] = _SECRET_ARGS[arg]
+    return " ".join(masked)
+
+
 @dataclass
 class SyncTask:
     """
@@ -24,8 +79,21 @@ class SyncTask:
     status: SyncStatus = SyncStatus.PENDING
     current_step: str = ""
     progress: int = 0
-    logs: List[str] = field(default_factory=list)
+    logs: Deque[str] = field(
+        default_factory=lambda: deque(maxlen=settings.max_log_lines)
+    )
+    total_log_lines: int = 0
     error: Optional[str] = None
+    finished_at: Optional[float] = None
+    
+    def add_log(self, line: str) -> None:
+        """
+        追加一行日志，超出上限时丢弃最早的日志
+        :param line:
+        :return:
+        """
+        self.logs.append(line)
+        self.total_log_lines += 1
 
 
 class ImageSyncService:
@@ -35,134 +103,225 @@ class ImageSyncService:
     """
     
     def __init__(self):
-        self.tasks: Dict[str, SyncTask] = {}
-        self._callbacks: Dict[str, List[Callable]] = {}
+        self.tasks: OrderedDict[str, SyncTask] = OrderedDict()
+        self._tool_cache: Dict[str, tuple[bool, float]] = {}
+        self._running: Set[asyncio.Task] = set()
+        self._sync_slots: Optional[asyncio.Semaphore] = None
+        self._http_clients: Dict[bool, httpx.AsyncClient] = {}
+        # registry -> 当前 docker 登录的 (username, sha256(password))，以及正在使用该登录的同步数
+        self._docker_logins: Dict[str, tuple[str, str]] = {}
+        self._login_users: Dict[str, int] = {}
+        self._login_conditions: Dict[str, asyncio.Condition] = {}
     
     def parse_image_reference(
             self,
             image_ref: str
-    ) -> tuple[str, str, str]:
+    ) -> tuple[str, str, Optional[str], Optional[str]]:
         """
-        解析镜像引用，提取 registry、name 和 tag
+        解析镜像引用，提取 registry、name、tag 和 digest
         :param image_ref:
-        :return: (registry, name, tag)
-        """
-        # 默认 registry 是 docker.io
-        registry = "docker.io"
-        tag = "latest"
-        
-        # 检查是否包含 registry
-        if "/" in image_ref:
-            parts = image_ref.split("/")
-            if "." in parts[0] or ":" in parts[0]:
-                registry = parts[0]
-                image_ref = "/".join(parts[1:])
-        
-        # 检查是否包含 tag
-        if ":" in image_ref:
-            name, tag = image_ref.rsplit(":", 1)
-        else:
-            name = image_ref
+        :return: (registry, name, tag, digest)，未指定 digest 时 digest 为 None，
+                 只指定 digest 未指定 tag 时 tag 为 None
+        """
+        match = _IMAGE_REF_RE.match(image_ref)
+        if not match:
+            raise ValueError(f"无效的镜像地址: {image_ref}")
+        
+        # 默认 registry 是 docker.io；未指定 digest 时默认 tag 是 latest
+        registry = match.group("registry") or "docker.io"
+        name = match.group("name")
+        digest = match.group("digest")
+        tag = match.group("tag") or (None if digest else "latest")
         
         # 处理官方镜像（添加 library 前缀）
         if registry == "docker.io" and "/" not in name:
             name = f"library/{name}"
         
-        return registry, name, tag
+        return registry, name, tag, digest
     
-    def check_tool_available(self, tool: str) -> bool:
+    async def _cached_check(
+            self,
+            key: str,
+            probe: Callable[[], Awaitable[bool]]
+    ) -> bool:
         """
-        检查命令行工具是否可用
-        :param tool:
+        读取工具可用性缓存，缓存过期（TOOLS_AVAILABILITY_TTL 秒）后重新探测
+        TTL 小于等于 0 时缓存永不过期
+        :param key:
+        :param probe:
+        :return:
+        """
+        cached = self._tool_cache.get(key)
+        ttl = settings.tools_availability_ttl
+        if cached and (ttl <= 0 or time.monotonic() - cached[1] < ttl):
+            return cached[0]
+        
+        available = await probe()
+        self._tool_cache[key] = (available, time.monotonic())
+        return available
+    
+    def invalidate_tool_cache(self) -> None:
+        """
+        清空工具可用性缓存
+        :return:
+        """
+        self._tool_cache.clear()
+    
+    async def _probe_command(self, cmd: List[str]) -> bool:
+        """
+        异步执行探测命令，返回是否成功
+        :param cmd:
         :return:
         """
         try:
-            result = subprocess.run(
-                [tool, "--version"],
-                capture_output=True,
-                timeout=10
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
             )
-            return result.returncode == 0
-        except (subprocess.TimeoutExpired, FileNotFoundError):
+        except OSError:
+            return False
+        
+        try:
+            return await asyncio.wait_for(process.wait(), timeout=10) == 0
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
             return False
     
-    def check_docker_available(self) -> bool:
+    async def check_tool_available(self, tool: str) -> bool:
+        """
+        检查命令行工具是否可用（只在 PATH 中查找可执行文件，不启动进程）
+        :param tool:
+        :return:
+        """
+        return shutil.which(tool) is not None
+    
+    async def check_docker_available(self) -> bool:
         """
         检查 Docker 是否可用
         :return:
         """
-        return self.check_tool_available("docker")
+        return await self.check_tool_available("docker")
     
-    def check_buildx_available(self) -> bool:
+    async def check_buildx_available(self) -> bool:
         """
         检查 Docker Buildx 是否可用
         :return:
         """
-        try:
-            result = subprocess.run(
-                ["docker", "buildx", "version"],
-                capture_output=True,
-                timeout=10
-            )
-            return result.returncode == 0
-        except (subprocess.TimeoutExpired, FileNotFoundError):
+        if not await self.check_docker_available():
             return False
+        
+        return await self._cached_check(
+            "docker-buildx",
+            lambda: self._probe_command(["docker", "buildx", "version"])
+        )
     
-    def check_skopeo_available(self) -> bool:
+    async def check_skopeo_available(self) -> bool:
         """
         检查 Skopeo 是否可用
         :return:
         """
-        return self.check_tool_available("skopeo")
+        return await self.check_tool_available("skopeo")
     
     async def run_command(
             self,
             cmd: List[str],
             task: SyncTask,
-            stdin_input: Optional[str] = None
+            stdin_input: Optional[str] = None,
+            on_line: Optional[Callable[[str], None]] = None
     ) -> tuple[bool, str]:
         """
-        异步执行命令并记录日志
+        异步执行命令并记录日志，stdout 与 stderr 分别读取，stderr 行带 [stderr] 前缀
         :param cmd:
         :param task:
         :param stdin_input: 可选的 stdin 输入
-        :return: (success, output)
+        :param on_line: 可选的逐行回调（用于解析进度）
+        :return: (success, output)，output 为输出的最后若干行
         """
-        cmd_str = " ".join(cmd)
-        # 隐藏密码（docker login 和 skopeo 的凭据）
-        safe_cmd_str = re.sub(r'--password\s+\S+', '--password ***', cmd_str)
-        safe_cmd_str = re.sub(r'--dest-creds\s+\S+', '--dest-creds ***:***', safe_cmd_str)
-        task.logs.append(f"$ {safe_cmd_str}")
+        task.add_log(f"$ {_mask_command(cmd)}")
         
+        process = None
         try:
             process = await asyncio.create_subprocess_exec(
                 *cmd,
                 stdin=asyncio.subprocess.PIPE if stdin_input else None,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.STDOUT
+                stderr=asyncio.subprocess.PIPE,
+                limit=_STREAM_LIMIT
             )
             
             if stdin_input:
-                stdout, _ = await process.communicate(input=stdin_input.encode())
-            else:
-                stdout, _ = await process.communicate()
+                process.stdin.write(stdin_input.encode())
+                await process.stdin.drain()
+                process.stdin.close()
             
-            output = stdout.decode("utf-8", errors="replace")
+            # 读取协程只把原始行放入队列，由单独的协程解码、解析进度并写入日志，
+            # 避免日志处理拖慢管道读取；只保留末尾几行作为返回值
+            lines: asyncio.Queue = asyncio.Queue(maxsize=_LINE_QUEUE_SIZE)
+            tail: Deque[str] = deque(maxlen=_OUTPUT_TAIL_LINES)
+            
+            async def _read_stream(
+                    stream: asyncio.StreamReader,
+                    prefix: str
+            ) -> None:
+                async for raw in stream:
+                    await lines.put((prefix, raw))
+                await lines.put(None)
+            
+            async def _handle_lines(streams: int) -> None:
+                # 每个读取协程结束时放入一个 None
+                while streams:
+                    item = await lines.get()
+                    if item is None:
+                        streams -= 1
+                        continue
+                    prefix, raw = item
+                    line = raw.decode("utf-8", errors="replace").rstrip()
+                    if not line.strip():
+                        continue
+                    task.add_log(f"{prefix}{line}")
+                    tail.append(line)
+                    if on_line:
+                        on_line(line)
+            
+            workers = [
+                asyncio.create_task(_read_stream(process.stdout, "")),
+                asyncio.create_task(_read_stream(process.stderr, "[stderr] ")),
+                asyncio.create_task(_handle_lines(2)),
+            ]
+            try:
+                # 任一协程出错时立即返回，其余协程在 finally 中取消，避免阻塞在已满的队列上
+                done, _ = await asyncio.wait(
+                    workers,
+                    return_when=asyncio.FIRST_EXCEPTION
+                )
+                for worker in done:
+                    if worker.exception():
+                        raise worker.exception()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
             
-            for line in output.strip().split("\n"):
-                if line.strip():
-                    task.logs.append(line)
+            returncode = await process.wait()
+            output = "\n".join(tail)
             
-            success = process.returncode == 0
+            success = returncode == 0
             if not success:
-                task.logs.append(f"命令执行失败，返回码: {process.returncode}")
+                task.add_log(f"命令执行失败，返回码: {returncode}")
             
             return success, output
             
         except Exception as e:
             error_msg = f"执行命令时出错: {str(e)}"
-            task.logs.append(error_msg)
+            task.add_log(error_msg)
             return False, error_msg
+        
+        finally:
+            if process and process.returncode is None:
+                process.kill()
+                await process.wait()
     
     async def run_command_silent(
             self,
@@ -185,6 +344,42 @@ class ImageSyncService:
         except Exception as e:
             return False, str(e)
     
+    async def _resolve_platform_sources(
+            self,
+            full_source: str,
+            repository: str,
+            platforms: List[Platform]
+    ) -> Dict[str, str]:
+        """
+        通过 manifest list 解析各平台镜像的 digest 引用
+        解析失败或镜像不是多平台镜像时返回空字典
+        :param full_source:
+        :param repository: 不含 tag/digest 的镜像仓库地址
+        :param platforms:
+        :return: {platform: "name@sha256:..."}
+        """
+        success, output = await self.run_command_silent(
+            ["docker", "manifest", "inspect", full_source]
+        )
+        if not success:
+            return {}
+        
+        try:
+            manifests = json.loads(output).get("manifests", [])
+        except (ValueError, AttributeError):
+            return {}
+        
+        wanted = {p.value for p in platforms}
+        sources = {}
+        
+        for manifest in manifests:
+            platform = manifest.get("platform", {})
+            platform_str = f"{platform.get('os')}/{platform.get('architecture')}"
+            if platform_str in wanted and platform_str not in sources:
+                sources[platform_str] = f"{repository}@{manifest.get('digest')}"
+        
+        return sources
+    
     async def sync_image_with_docker(
             self,
             task: SyncTask,
@@ -198,86 +393,187 @@ class ImageSyncService:
         :param harbor_password:
         :return:
         """
-        source_registry, source_name, source_tag = self.parse_image_reference(
+        source_registry, source_name, source_tag, source_digest = self.parse_image_reference(
             task.source_image
         )
         
-        # 构建完整的源镜像地址
+        # 构建完整的源镜像地址（指定 digest 时按 digest 拉取）
         if source_registry == "docker.io":
-            full_source = f"{source_name}:{source_tag}"
+            repository = source_name
+        else:
+            repository = f"{source_registry}/{source_name}"
+        
+        if source_digest:
+            full_source = f"{repository}@{source_digest}"
         else:
-            full_source = f"{source_registry}/{source_name}:{source_tag}"
+            full_source = f"{repository}:{source_tag}"
         
         target_registry = task.target_image.split("/")[0]
         
-        # 登录到目标 Harbor
-        if harbor_username and harbor_password:
-            task.current_step = "登录到 Harbor"
-            task.progress = 5
-            task.logs.append(f"正在登录到 {target_registry}...")
-            task.logs.append(f"用户名: {harbor_username}")
-            
-            # 使用 --password-stdin 安全传递密码
-            success, output = await self.run_command(
-                [
-                    "docker", "login",
-                    "-u", harbor_username,
-                    "--password-stdin",
-                    target_registry
-                ],
+        if not (harbor_username and harbor_password):
+            return await self._transfer_with_docker(task, repository, full_source)
+        
+        # docker 每个 registry 只保存一份凭据，登录后直到推送完成前都不能被其他凭据覆盖
+        if not await self._acquire_docker_login(
                 task,
-                stdin_input=harbor_password
+                target_registry,
+                harbor_username,
+                harbor_password
+        ):
+            return False
+        
+        try:
+            return await self._transfer_with_docker(task, repository, full_source)
+        finally:
+            await self._release_docker_login(target_registry)
+    
+    async def _acquire_docker_login(
+            self,
+            task: SyncTask,
+            registry: str,
+            username: str,
+            password: str
+    ) -> bool:
+        """
+        确保 docker 以指定凭据登录到 registry，并登记为该登录的使用者
+        凭据与当前登录一致时跳过登录；不一致时等待使用旧凭据的同步结束后再重新登录
+        :param task:
+        :param registry:
+        :param username:
+        :param password:
+        :return: 是否登录成功
+        """
+        credential = (username, hashlib.sha256(password.encode()).hexdigest())
+        condition = self._login_conditions.setdefault(registry, asyncio.Condition())
+        
+        async with condition:
+            await condition.wait_for(
+                lambda: self._docker_logins.get(registry) == credential
+                or not self._login_users.get(registry)
             )
             
-            if not success:
-                task.error = f"Harbor 登录失败: {output}"
-                return False
+            if self._docker_logins.get(registry) == credential:
+                task.add_log(f"已登录到 {registry}，跳过登录")
+            else:
+                task.current_step = "登录到 Harbor"
+                task.progress = 5
+                task.add_log(f"正在登录到 {registry}...")
+                task.add_log(f"用户名: {username}")
+                
+                # 使用 --password-stdin 安全传递密码
+                success, output = await self.run_command(
+                    [
+                        "docker", "login",
+                        "-u", username,
+                        "--password-stdin",
+                        registry
+                    ],
+                    task,
+                    stdin_input=password
+                )
+                
+                if not success:
+                    self._docker_logins.pop(registry, None)
+                    task.error = f"Harbor 登录失败: {output}"
+                    return False
+                
+                self._docker_logins[registry] = credential
+                task.add_log("Harbor 登录成功")
             
-            task.logs.append("Harbor 登录成功")
+            self._login_users[registry] = self._login_users.get(registry, 0) + 1
+            return True
+    
+    async def _release_docker_login(self, registry: str) -> None:
+        """
+        注销 registry 登录的一个使用者，并唤醒等待更换凭据的同步
+        :param registry:
+        :return:
+        """
+        condition = self._login_conditions[registry]
+        async with condition:
+            self._login_users[registry] -= 1
+            condition.notify_all()
+    
+    async def _transfer_with_docker(
+            self,
+            task: SyncTask,
+            repository: str,
+            full_source: str
+    ) -> bool:
+        """
+        使用 Docker 拉取各平台镜像、推送并创建多平台 manifest
+        :param task:
+        :param repository: 不含 tag/digest 的源镜像仓库地址
+        :param full_source:
+        :return:
+        """
+        target_registry = task.target_image.split("/")[0]
+        
+        # 解析各平台的 digest 引用，使各平台可以并发拉取而互不覆盖本地 tag
+        platform_sources = await self._resolve_platform_sources(
+            full_source,
+            repository,
+            task.platforms
+        )
         
-        pulled_images = []
+        task.current_step = "拉取镜像"
+        task.progress = 10
+        pulled_count = 0
         
-        # 为每个平台拉取镜像
-        for i, platform in enumerate(task.platforms):
+        async def _pull_and_tag(platform: Platform) -> Optional[tuple[str, str]]:
+            nonlocal pulled_count
             platform_str = platform.value
             arch = platform_str.split("/")[1]
+            source_ref = platform_sources.get(platform_str, full_source)
             
-            task.current_step = f"拉取 {arch} 架构镜像"
-            task.progress = 10 + (i * 30)
-            task.logs.append(f"正在拉取 {full_source} ({platform_str})...")
+            task.add_log(f"正在拉取 {source_ref} ({platform_str})...")
             
             success, _ = await self.run_command(
-                ["docker", "pull", "--platform", platform_str, full_source],
+                ["docker", "pull", "--platform", platform_str, source_ref],
                 task
             )
             
+            pulled_count += 1
+            task.progress = 10 + pulled_count * 60 // len(task.platforms)
+            
             if not success:
-                task.logs.append(f"警告: {platform_str} 架构拉取失败，跳过")
-                continue
+                task.add_log(f"警告: {platform_str} 架构拉取失败，跳过")
+                return None
             
             # 为该平台的镜像打 tag
             target_with_arch = f"{task.target_image}-{arch}"
             
-            task.logs.append(f"为 {arch} 镜像打标签: {target_with_arch}")
+            task.add_log(f"为 {arch} 镜像打标签: {target_with_arch}")
             success, _ = await self.run_command(
-                ["docker", "tag", full_source, target_with_arch],
+                ["docker", "tag", source_ref, target_with_arch],
                 task
             )
             
-            if success:
-                pulled_images.append((platform_str, target_with_arch))
+            return (platform_str, target_with_arch) if success else None
+        
+        if len(platform_sources) == len(task.platforms):
+            # 各平台引用互不相同，并发拉取
+            results = await asyncio.gather(
+                *(_pull_and_tag(p) for p in task.platforms),
+                return_exceptions=True
+            )
+        else:
+            # 共用同一个源 tag，并发拉取会互相覆盖，只能逐个拉取
+            results = [await _pull_and_tag(p) for p in task.platforms]
+        
+        pulled_images = [r for r in results if isinstance(r, tuple)]
         
         if not pulled_images:
             task.error = "没有成功拉取任何平台的镜像"
             return False
         
-        # 推送各平台镜像
+        # 并发推送各平台镜像
         task.current_step = "推送镜像到 Harbor"
         task.progress = 70
         
-        for platform_str, target_image in pulled_images:
+        async def _push(platform_str: str, target_image: str) -> None:
             arch = platform_str.split("/")[1]
-            task.logs.append(f"正在推送 {arch} 架构镜像...")
+            task.add_log(f"正在推送 {arch} 架构镜像...")
             
             success, _ = await self.run_command(
                 ["docker", "push", target_image],
@@ -285,7 +581,14 @@ class ImageSyncService:
             )
             
             if not success:
-                task.logs.append(f"警告: {arch} 架构推送失败")
+                # 登录状态可能已失效，下次同步时重新登录
+                self._docker_logins.pop(target_registry, None)
+                task.add_log(f"警告: {arch} 架构推送失败")
+        
+        await asyncio.gather(
+            *(_push(p, img) for p, img in pulled_images),
+            return_exceptions=True
+        )
         
         # 创建并推送 manifest
         task.current_step = "创建多平台 manifest"
@@ -294,10 +597,10 @@ class ImageSyncService:
         manifest_images = [img for _, img in pulled_images]
         
         if len(manifest_images) > 1:
-            task.logs.append("创建多平台 manifest...")
+            task.add_log("创建多平台 manifest...")
             
             # 先删除可能存在的旧 manifest（忽略错误，因为可能不存在）
-            task.logs.append("清理旧 manifest（如果存在）...")
+            task.add_log("清理旧 manifest（如果存在）...")
             await self.run_command_silent(
                 ["docker", "manifest", "rm", task.target_image]
             )
@@ -309,31 +612,184 @@ class ImageSyncService:
             success, _ = await self.run_command(create_cmd, task)
             
             if success:
-                task.logs.append("推送多平台 manifest...")
+                task.add_log("推送多平台 manifest...")
                 success, _ = await self.run_command(
                     ["docker", "manifest", "push", task.target_image],
                     task
                 )
                 
                 if not success:
-                    task.logs.append("警告: manifest 推送失败，但各平台镜像已推送成功")
+                    self._docker_logins.pop(target_registry, None)
+                    task.add_log("警告: manifest 推送失败，但各平台镜像已推送成功")
         
         # 清理本地镜像
         task.current_step = "清理本地镜像"
         task.progress = 95
-        task.logs.append("清理本地镜像...")
+        task.add_log("清理本地镜像...")
         
         # 删除推送的目标镜像
         for _, target_image in pulled_images:
             await self.run_command_silent(["docker", "rmi", target_image])
         
         # 删除拉取的源镜像
-        await self.run_command_silent(["docker", "rmi", full_source])
+        source_refs = {
+            platform_sources.get(p.value, full_source) for p in task.platforms
+        }
+        for source_ref in source_refs:
+            await self.run_command_silent(["docker", "rmi", source_ref])
         
-        task.logs.append("本地镜像已清理")
+        task.add_log("本地镜像已清理")
         task.progress = 100
         return True
     
+    def _get_http_client(self, verify: bool = True) -> httpx.AsyncClient:
+        """
+        获取共享的 registry HTTP 客户端（按是否校验 TLS 分别复用连接）
+        :param verify:
+        :return:
+        """
+        client = self._http_clients.get(verify)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=True,
+                verify=verify,
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=32)
+            )
+            self._http_clients[verify] = client
+        return client
+    
+    async def _fetch_registry_token(
+            self,
+            client: httpx.AsyncClient,
+            challenge: str,
+            auth: Optional[tuple[str, str]] = None
+    ) -> Optional[str]:
+        """
+        按 WWW-Authenticate: Bearer realm=...,service=...,scope=... 获取 token
+        :param client:
+        :param challenge:
+        :param auth:
+        :return:
+        """
+        params = dict(_AUTH_PARAM_RE.findall(challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            return None
+        
+        response = await client.get(realm, params=params, auth=auth)
+        if response.status_code != 200:
+            return None
+        
+        body = response.json()
+        return body.get("token") or body.get("access_token")
+    
+    async def get_manifest_digest(
+            self,
+            registry: str,
+            name: str,
+            tag: str,
+            auth: Optional[tuple[str, str]] = None,
+            verify: bool = True
+    ) -> Optional[str]:
+        """
+        通过 Registry v2 API 读取镜像 manifest（或 manifest list）的 digest
+        镜像不存在或请求失败时返回 None
+        :param registry:
+        :param name:
+        :param tag: tag 或 digest
+        :param auth: (username, password)
+        :param verify: 是否校验 TLS 证书
+        :return:
+        """
+        client = self._get_http_client(verify)
+        host = "registry-1.docker.io" if registry == "docker.io" else registry
+        url = f"https://{host}/v2/{name}/manifests/{tag}"
+        headers = {"Accept": _MANIFEST_ACCEPT}
+        
+        try:
+            response = await client.head(url, headers=headers)
+            
+            if response.status_code == 401:
+                challenge = response.headers.get("WWW-Authenticate", "")
+                if challenge.lower().startswith("bearer"):
+                    token = await self._fetch_registry_token(client, challenge, auth)
+                    if not token:
+                        return None
+                    headers["Authorization"] = f"Bearer {token}"
+                    response = await client.head(url, headers=headers)
+                elif auth:
+                    response = await client.head(url, headers=headers, auth=auth)
+        except (httpx.HTTPError, ValueError):
+            return None
+        
+        if response.status_code != 200:
+            return None
+        return response.headers.get("Docker-Content-Digest")
+    
+    async def target_already_has(
+            self,
+            task: SyncTask,
+            harbor_username: Optional[str] = None,
+            harbor_password: Optional[str] = None
+    ) -> bool:
+        """
+        判断目标镜像的 manifest digest 是否与源镜像一致
+        :param task:
+        :param harbor_username:
+        :param harbor_password:
+        :return:
+        """
+        source_registry, source_name, source_tag, source_digest = self.parse_image_reference(
+            task.source_image
+        )
+        target_registry, target_path = task.target_image.split("/", 1)
+        target_name, target_tag = target_path.rsplit(":", 1)
+        
+        target_auth = None
+        if harbor_username and harbor_password:
+            target_auth = (harbor_username, harbor_password)
+        
+        source_digest, target_digest = await asyncio.gather(
+            self.get_manifest_digest(
+                source_registry,
+                source_name,
+                source_digest or source_tag,
+                verify=settings.skopeo_src_tls_verify
+            ),
+            self.get_manifest_digest(
+                target_registry,
+                target_name,
+                target_tag,
+                auth=target_auth,
+                verify=settings.skopeo_dest_tls_verify
+            )
+        )
+        return source_digest is not None and source_digest == target_digest
+    
+    def _write_authfile(
+            self,
+            registry: str,
+            username: str,
+            password: str
+    ) -> str:
+        """
+        生成容器 registry 认证文件（auth.json 格式），调用方负责删除
+        :param registry:
+        :param username:
+        :param password:
+        :return: 文件路径
+        """
+        auth = base64.b64encode(f"{username}:{password}".encode()).decode()
+        # NamedTemporaryFile 创建的文件权限为 0600
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                suffix=".json",
+                delete=False
+        ) as f:
+            json.dump({"auths": {registry: {"auth": auth}}}, f)
+        return f.name
+    
     async def sync_image_with_skopeo(
             self,
             task: SyncTask,
@@ -347,15 +803,16 @@ class ImageSyncService:
         :param harbor_password:
         :return:
         """
-        source_registry, source_name, source_tag = self.parse_image_reference(
+        source_registry, source_name, source_tag, source_digest = self.parse_image_reference(
             task.source_image
         )
         
-        # 构建 skopeo 格式的源地址
-        if source_registry == "docker.io":
-            source_ref = f"docker://docker.io/{source_name}:{source_tag}"
+        # 构建 skopeo 格式的源地址（skopeo 不支持同时指定 tag 和 digest）
+        source_ref = f"docker://{source_registry}/{source_name}"
+        if source_digest:
+            source_ref = f"{source_ref}@{source_digest}"
         else:
-            source_ref = f"docker://{source_registry}/{source_name}:{source_tag}"
+            source_ref = f"{source_ref}:{source_tag}"
         
         target_ref = f"docker://{task.target_image}"
         
@@ -365,60 +822,111 @@ class ImageSyncService:
         # 构建 skopeo copy 命令
         cmd = ["skopeo", "copy", "--all"]
         
-        if harbor_username and harbor_password:
+        if settings.skopeo_preserve_digests:
+            cmd.append("--preserve-digests")
+        if not settings.skopeo_src_tls_verify:
+            cmd.append("--src-tls-verify=false")
+        if not settings.skopeo_dest_tls_verify:
+            cmd.append("--dest-tls-verify=false")
+        if settings.skopeo_image_parallel_copies:
             cmd.extend([
-                "--dest-creds",
-                f"{harbor_username}:{harbor_password}"
+                "--image-parallel-copies",
+                str(settings.skopeo_image_parallel_copies)
             ])
         
+        # 凭据写入临时 authfile，避免出现在进程参数中
+        authfile = None
+        if harbor_username and harbor_password:
+            authfile = self._write_authfile(
+                task.target_image.split("/")[0],
+                harbor_username,
+                harbor_password
+            )
+            cmd.extend(["--dest-authfile", authfile])
+        
         cmd.extend([source_ref, target_ref])
         
-        task.logs.append(f"从 {source_ref} 复制到 {target_ref}")
-        task.logs.append("正在复制所有平台架构的镜像...")
+        def _on_line(line: str) -> None:
+            # 多平台复制时 skopeo 会输出 "Copying image sha256:... (i/n)"
+            match = _SKOPEO_IMAGE_RE.search(line)
+            if match:
+                current, total = int(match.group(1)), int(match.group(2))
+                task.progress = max(task.progress, 10 + 85 * (current - 1) // total)
         
-        success, _ = await self.run_command(cmd, task)
+        try:
+            # 目标已存在相同 digest 的镜像时无需再复制
+            if await self.target_already_has(task, harbor_username, harbor_password):
+                task.add_log("目标已包含相同 digest 的镜像，跳过复制")
+                task.progress = 100
+                return True
+            
+            task.add_log(f"从 {source_ref} 复制到 {target_ref}")
+            task.add_log("正在复制所有平台架构的镜像...")
+            
+            success, _ = await self.run_command(cmd, task, on_line=_on_line)
+        finally:
+            if authfile:
+                os.unlink(authfile)
         
         task.progress = 100
         return success
     
-    async def sync_image(
+    def create_task(
             self,
             source_image: str,
             target_image: str,
-            platforms: List[Platform],
-            harbor_username: Optional[str] = None,
-            harbor_password: Optional[str] = None,
-            use_skopeo: bool = False
+            platforms: List[Platform]
     ) -> SyncTask:
         """
-        执行镜像同步任务
+        创建并登记同步任务（尚未开始执行）
         :param source_image:
         :param target_image:
         :param platforms:
-        :param harbor_username:
-        :param harbor_password:
-        :param use_skopeo:
         :return:
         """
-        task_id = str(uuid.uuid4())[:8]
-        
         task = SyncTask(
-            task_id=task_id,
+            task_id=str(uuid.uuid4())[:8],
             source_image=source_image,
             target_image=target_image,
             platforms=platforms,
-            status=SyncStatus.PULLING
+            status=SyncStatus.PENDING
         )
+        self.add_task(task)
+        return task
+    
+    async def start_sync(
+            self,
+            task: SyncTask,
+            harbor_username: Optional[str] = None,
+            harbor_password: Optional[str] = None,
+            use_skopeo: Optional[bool] = None
+    ) -> bool:
+        """
+        执行已登记的同步任务，并记录最终状态
+        :param task:
+        :param harbor_username:
+        :param harbor_password:
+        :param use_skopeo: 为 None 时 Skopeo 可用即使用
+        :return: 是否同步成功
+        """
+        skopeo_available = await self.check_skopeo_available()
+        if use_skopeo is None:
+            use_skopeo = skopeo_available
+        else:
+            use_skopeo = use_skopeo and skopeo_available
         
-        self.tasks[task_id] = task
-        
-        task.logs.append(f"开始同步任务: {task_id}")
-        task.logs.append(f"源镜像: {source_image}")
-        task.logs.append(f"目标镜像: {target_image}")
-        task.logs.append(f"平台: {[p.value for p in platforms]}")
+        task.status = SyncStatus.PULLING
+        task.add_log(f"开始同步任务: {task.task_id}")
+        task.add_log(f"源镜像: {task.source_image}")
+        task.add_log(f"目标镜像: {task.target_image}")
+        task.add_log(f"平台: {[p.value for p in task.platforms]}")
+        task.add_log(f"同步方式: {'skopeo' if use_skopeo else 'docker'}")
+        if not skopeo_available:
+            task.add_log("提示: 未检测到 Skopeo，使用 Docker 拉取/推送模式，安装 Skopeo 可免去本地存储")
         
+        success = False
         try:
-            if use_skopeo and self.check_skopeo_available():
+            if use_skopeo:
                 success = await self.sync_image_with_skopeo(
                     task,
                     harbor_username,
@@ -434,22 +942,137 @@ class ImageSyncService:
             if success:
                 task.status = SyncStatus.SUCCESS
                 task.current_step = "同步完成"
-                task.logs.append("✅ 镜像同步成功!")
+                task.add_log("✅ 镜像同步成功!")
             else:
                 task.status = SyncStatus.FAILED
                 task.current_step = "同步失败"
                 if not task.error:
                     task.error = "同步过程中发生错误"
-                task.logs.append(f"❌ 同步失败: {task.error}")
+                task.add_log(f"❌ 同步失败: {task.error}")
                 
         except Exception as e:
             task.status = SyncStatus.FAILED
             task.error = str(e)
             task.current_step = "发生异常"
-            task.logs.append(f"❌ 发生异常: {str(e)}")
+            task.add_log(f"❌ 发生异常: {str(e)}")
         
+        task.finished_at = time.monotonic()
+        return success
+    
+    async def sync_image(
+            self,
+            source_image: str,
+            target_image: str,
+            platforms: List[Platform],
+            harbor_username: Optional[str] = None,
+            harbor_password: Optional[str] = None,
+            use_skopeo: Optional[bool] = None
+    ) -> SyncTask:
+        """
+        创建并执行镜像同步任务
+        :param source_image:
+        :param target_image:
+        :param platforms:
+        :param harbor_username:
+        :param harbor_password:
+        :param use_skopeo: 为 None 时 Skopeo 可用即使用
+        :return:
+        """
+        task = self.create_task(source_image, target_image, platforms)
+        await self.start_sync(task, harbor_username, harbor_password, use_skopeo)
         return task
     
+    def add_task(self, task: SyncTask) -> None:
+        """
+        登记任务，超出 MAX_TASKS 时淘汰最早结束的任务
+        未结束的任务不会被淘汰，全部任务都未结束时拒绝登记
+        :param task:
+        :return:
+        """
+        self.prune_tasks()
+        
+        if len(self.tasks) >= settings.max_tasks:
+            finished = [
+                task_id for task_id, t in self.tasks.items()
+                if t.finished_at is not None
+            ]
+            for task_id in finished[:len(self.tasks) - settings.max_tasks + 1]:
+                del self.tasks[task_id]
+        
+        if len(self.tasks) >= settings.max_tasks:
+            raise RuntimeError(f"进行中的任务已达上限 ({settings.max_tasks})，请稍后再试")
+        
+        self.tasks[task.task_id] = task
+    
+    def run_in_background(
+            self,
+            task: SyncTask,
+            harbor_username: Optional[str] = None,
+            harbor_password: Optional[str] = None,
+            use_skopeo: Optional[bool] = None
+    ) -> None:
+        """
+        在后台执行同步任务，MAX_CONCURRENT_SYNCS 大于 0 时限制同时运行的任务数
+        :param task:
+        :param harbor_username:
+        :param harbor_password:
+        :param use_skopeo: 为 None 时 Skopeo 可用即使用
+        :return:
+        """
+        if self._sync_slots is None and settings.max_concurrent_syncs > 0:
+            self._sync_slots = asyncio.Semaphore(settings.max_concurrent_syncs)
+        
+        async def _run() -> None:
+            if self._sync_slots is None:
+                await self.start_sync(
+                    task,
+                    harbor_username,
+                    harbor_password,
+                    use_skopeo
+                )
+                return
+            
+            if self._sync_slots.locked():
+                task.add_log("等待其他同步任务完成...")
+            async with self._sync_slots:
+                await self.start_sync(
+                    task,
+                    harbor_username,
+                    harbor_password,
+                    use_skopeo
+                )
+        
+        running = asyncio.create_task(_run())
+        self._running.add(running)
+        running.add_done_callback(self._running.discard)
+    
+    async def shutdown(self) -> None:
+        """
+        取消仍在运行的后台同步任务并关闭 registry HTTP 客户端
+        :return:
+        """
+        for running in self._running:
+            running.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        
+        for client in self._http_clients.values():
+            await client.aclose()
+        self._http_clients.clear()
+        
+    
+    def prune_tasks(self) -> None:
+        """
+        删除已结束超过 FINISHED_TASK_TTL 秒的任务
+        :return:
+        """
+        deadline = time.monotonic() - settings.finished_task_ttl
+        expired = [
+            task_id for task_id, task in self.tasks.items()
+            if task.finished_at is not None and task.finished_at < deadline
+        ]
+        for task_id in expired:
+            del self.tasks[task_id]
+    
     def get_task(self, task_id: str) -> Optional[SyncTask]:
         """
         获取任务状态
@@ -458,22 +1081,50 @@ class ImageSyncService:
         """
         return self.tasks.get(task_id)
     
-    def get_task_progress(self, task_id: str) -> Optional[SyncProgress]:
+    def get_task_etag(self, task_id: str, since: int = 0) -> Optional[str]:
+        """
+        根据任务当前状态生成进度响应的 ETag，任务不存在时返回 None
+        :param task_id:
+        :param since:
+        :return:
+        """
+        task = self.tasks.get(task_id)
+        if not task:
+            return None
+        
+        state = (
+            f"{task.status.value}|{task.progress}|{task.current_step}|"
+            f"{task.total_log_lines}|{task.error}|{since}"
+        )
+        return f'"{hashlib.sha1(state.encode()).hexdigest()}"'
+    
+    def get_task_progress(
+            self,
+            task_id: str,
+            since: int = 0
+    ) -> Optional[SyncProgress]:
         """
-        获取任务进度
+        获取任务进度，只返回行号 since 之后的日志（已被丢弃的行不再返回）
         :param task_id:
+        :param since: 客户端已接收的日志行数
         :return:
         """
         task = self.tasks.get(task_id)
         if not task:
             return None
         
+        # logs 中第一行的行号 = 已被丢弃的行数
+        dropped = task.total_log_lines - len(task.logs)
+        start = min(max(0, since - dropped), len(task.logs))
+        
         return SyncProgress(
             task_id=task.task_id,
             status=task.status,
             current_step=task.current_step,
             progress=task.progress,
-            logs=task.logs.copy(),
+            logs=list(islice(task.logs, start, None)),
+            logs_offset=dropped + start,
+            total_log_lines=task.total_log_lines,
             error=task.error
         )
 
@@ -0,0 +1,124 @@
+"""
+docker login 共享与凭据切换单元测试（run_command 使用假实现，不调用真实 docker）
+"""
+import asyncio
+
+import pytest
+
+from app.models.schemas import Platform
+from app.services.image_sync import ImageSyncService
+
+REGISTRY = "harbor.local"
+TARGET = f"{REGISTRY}/library/nginx:1.25"
+
+
+class FakeDocker:
+    """
+    记录执行的命令，并按子命令返回预设结果
+    """
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.commands = []
+
+    async def run_command(self, cmd, task, stdin_input=None, on_line=None):
+        self.commands.append(cmd)
+        # 让出事件循环，使并发的同步任务交错执行
+        await asyncio.sleep(0)
+        success = cmd[1] not in self.fail
+        return success, "" if success else f"{cmd[1]} failed"
+
+    async def run_command_silent(self, cmd):
+        # manifest inspect 失败时按 tag 逐个拉取
+        return False, ""
+
+    @property
+    def logins(self):
+        return [cmd for cmd in self.commands if cmd[1] == "login"]
+
+
+@pytest.fixture
+def service():
+    return ImageSyncService()
+
+
+def _install(service, fake):
+    service.run_command = fake.run_command
+    service.run_command_silent = fake.run_command_silent
+
+
+def _new_task(service):
+    return service.create_task("nginx:1.25", TARGET, [Platform.AMD64])
+
+
+def test_same_credential_shares_login(service):
+    fake = FakeDocker()
+    _install(service, fake)
+
+    async def _run():
+        return await asyncio.gather(
+            service.sync_image_with_docker(_new_task(service), "admin", "secret"),
+            service.sync_image_with_docker(_new_task(service), "admin", "secret"),
+        )
+
+    assert asyncio.run(_run()) == [True, True]
+    assert len(fake.logins) == 1
+    assert service._login_users[REGISTRY] == 0
+
+
+def test_different_credential_waits_for_release(service):
+    fake = FakeDocker()
+    _install(service, fake)
+
+    async def _run():
+        assert await service._acquire_docker_login(
+            _new_task(service), REGISTRY, "alice", "a"
+        )
+        switch = asyncio.create_task(
+            service._acquire_docker_login(_new_task(service), REGISTRY, "bob", "b")
+        )
+        for _ in range(5):
+            await asyncio.sleep(0)
+        # alice 的登录仍在使用中，bob 必须等待
+        assert not switch.done()
+        assert len(fake.logins) == 1
+
+        await service._release_docker_login(REGISTRY)
+        assert await switch
+        await service._release_docker_login(REGISTRY)
+
+    asyncio.run(_run())
+    assert [cmd[3] for cmd in fake.logins] == ["alice", "bob"]
+    assert service._docker_logins[REGISTRY][0] == "bob"
+    assert service._login_users[REGISTRY] == 0
+
+
+def test_failed_push_clears_login(service):
+    fake = FakeDocker(fail={"push"})
+    _install(service, fake)
+
+    asyncio.run(
+        service.sync_image_with_docker(_new_task(service), "admin", "secret")
+    )
+    assert REGISTRY not in service._docker_logins
+    assert service._login_users[REGISTRY] == 0
+
+    # 下次同步需要重新登录
+    asyncio.run(
+        service.sync_image_with_docker(_new_task(service), "admin", "secret")
+    )
+    assert len(fake.logins) == 2
+
+
+def test_failed_login_does_not_register_user(service):
+    fake = FakeDocker(fail={"login"})
+    _install(service, fake)
+    task = _new_task(service)
+
+    assert not asyncio.run(
+        service.sync_image_with_docker(task, "admin", "wrong")
+    )
+    assert task.error.startswith("Harbor 登录失败")
+    assert REGISTRY not in service._docker_logins
+    assert service._login_users.get(REGISTRY, 0) == 0
+    assert not any(cmd[1] == "pull" for cmd in fake.commands)
@@ -0,0 +1,41 @@
+"""
+parse_image_reference 单元测试
+"""
+import pytest
+
+from app.services.image_sync import ImageSyncService
+
+DIGEST = "sha256:" + "a" * 64
+
+
+@pytest.fixture
+def service():
+    return ImageSyncService()
+
+
+@pytest.mark.parametrize(
+    "image_ref, expected",
+    [
+        ("nginx", ("docker.io", "library/nginx", "latest", None)),
+        ("nginx:1.25", ("docker.io", "library/nginx", "1.25", None)),
+        ("library/nginx", ("docker.io", "library/nginx", "latest", None)),
+        ("ghcr.io/owner/img:tag", ("ghcr.io", "owner/img", "tag", None)),
+        (
+            f"harbor.co:5000/proj/img@{DIGEST}",
+            ("harbor.co:5000", "proj/img", None, DIGEST)
+        ),
+        (
+            f"nginx:1.25@{DIGEST}",
+            ("docker.io", "library/nginx", "1.25", DIGEST)
+        ),
+        ("localhost:5000/img", ("localhost:5000", "img", "latest", None)),
+    ]
+)
+def test_parse_image_reference(service, image_ref, expected):
+    assert service.parse_image_reference(image_ref) == expected
+
+
+@pytest.mark.parametrize("image_ref", ["", "nginx:", "img:tag:extra"])
+def test_parse_image_reference_invalid(service, image_ref):
+    with pytest.raises(ValueError):
+        service.parse_image_reference(image_ref)
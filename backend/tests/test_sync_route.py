@@ -0,0 +1,28 @@
+"""
+POST /api/sync 参数校验测试
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.services.image_sync import image_sync_service
+
+DIGEST = "sha256:" + "a" * 64
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def _available():
+        return True
+
+    monkeypatch.setattr(image_sync_service, "check_docker_available", _available)
+    return TestClient(app)
+
+
+def test_digest_source_requires_target_tag(client):
+    response = client.post(
+        "/api/sync",
+        json={"source_image": f"nginx@{DIGEST}", "target_registry": "harbor.local"}
+    )
+    assert response.status_code == 400
+    assert image_sync_service.tasks == {}
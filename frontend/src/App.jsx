@@ -53,6 +53,8 @@ function App() {
   
   const logsEndRef = useRef(null)
   const pollIntervalRef = useRef(null)
+  // 已接收的服务端日志行号，轮询时只请求之后的新日志
+  const logCursorRef = useRef(0)
 
   // 滚动到日志底部
   const scrollToBottom = () => {
@@ -201,18 +203,19 @@ function App() {
     if (pollIntervalRef.current) {
       clearInterval(pollIntervalRef.current)
     }
+    logCursorRef.current = 0
 
     const poll = async () => {
       try {
-        const response = await fetch(`/api/sync/${taskId}`)
+        const response = await fetch(`/api/sync/${taskId}?since=${logCursorRef.current}`)
         const data = await response.json()
         
         setCurrentTask(data)
         
         // 更新日志（增量）
-        if (data.logs && data.logs.length > logs.length) {
-          const newLogs = data.logs.slice(logs.length)
-          newLogs.forEach(log => {
+        if (data.logs && data.logs.length > 0) {
+          logCursorRef.current = data.logs_offset + data.logs.length
+          data.logs.forEach(log => {
             let type = 'normal'
             if (log.startsWith('$')) type = 'command'
             else if (log.includes('✅') || log.includes('成功')) type = 'success'